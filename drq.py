@@ -2,7 +2,6 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import copy
 import math
 
 import utils
@@ -45,7 +44,7 @@ class Encoder(nn.Module):
             conv = torch.relu(self.convs[i](conv))
             self.outputs['conv%s' % (i + 1)] = conv
 
-        h = conv.view(conv.size(0), -1)
+        h = conv.reshape(conv.size(0), -1)
         return h
 
     def forward(self, obs, detach=False):
@@ -166,7 +165,7 @@ class DRQAgent(object):
     def __init__(self, obs_shape, action_shape, action_range, device,
                  encoder_cfg, critic_cfg, actor_cfg, discount,
                  init_temperature, lr, actor_update_frequency, critic_tau,
-                 critic_target_update_frequency, batch_size):
+                 critic_target_update_frequency, batch_size, amp):
         self.action_range = action_range
         self.device = device
         self.discount = discount
@@ -174,6 +173,8 @@ class DRQAgent(object):
         self.actor_update_frequency = actor_update_frequency
         self.critic_target_update_frequency = critic_target_update_frequency
         self.batch_size = batch_size
+        self.amp = amp
+        self.num_updates = 0
 
         self.actor = hydra.utils.instantiate(actor_cfg).to(self.device)
 
@@ -208,49 +209,53 @@ class DRQAgent(object):
     def alpha(self):
         return self.log_alpha.exp()
 
+    def autocast(self):
+        """Runs the forward passes of an update in bfloat16 if enabled."""
+        return torch.autocast(device_type=torch.device(self.device).type,
+                              dtype=torch.bfloat16,
+                              enabled=self.amp)
+
     def act(self, obs, sample=False):
-        obs = torch.FloatTensor(obs).to(self.device)
-        obs = obs.unsqueeze(0)
-        dist = self.actor(obs)
-        action = dist.sample() if sample else dist.mean
-        action = action.clamp(*self.action_range)
-        assert action.ndim == 2 and action.shape[0] == 1
-        return utils.to_np(action[0])
+        """Acts on a single observation or on a batch of them."""
+        with torch.no_grad():
+            obs = torch.FloatTensor(obs).to(self.device)
+            batched = obs.ndim == 4
+            if not batched:
+                obs = obs.unsqueeze(0)
+            dist = self.actor(obs)
+            action = dist.sample() if sample else dist.mean
+            action = action.clamp(*self.action_range)
+        assert action.ndim == 2
+        return utils.to_np(action if batched else action[0])
 
     def update_critic(self, obs, obs_aug, action, reward, next_obs,
                       next_obs_aug, not_done, logger, step):
-        with torch.no_grad():
-            dist = self.actor(next_obs)
-            next_action = dist.rsample()
-            log_prob = dist.log_prob(next_action).sum(-1, keepdim=True)
-            target_Q1, target_Q2 = self.critic_target(next_obs, next_action)
-            target_V = torch.min(target_Q1,
-                                 target_Q2) - self.alpha.detach() * log_prob
-            target_Q = reward + (not_done * self.discount * target_V)
-
-            dist_aug = self.actor(next_obs_aug)
-            next_action_aug = dist_aug.rsample()
-            log_prob_aug = dist_aug.log_prob(next_action_aug).sum(-1,
-                                                                  keepdim=True)
-            target_Q1, target_Q2 = self.critic_target(next_obs_aug,
-                                                      next_action_aug)
-            target_V = torch.min(
-                target_Q1, target_Q2) - self.alpha.detach() * log_prob_aug
-            target_Q_aug = reward + (not_done * self.discount * target_V)
-
-            target_Q = (target_Q + target_Q_aug) / 2
-
-        # get current Q estimates
-        current_Q1, current_Q2 = self.critic(obs, action)
-        critic_loss = F.mse_loss(current_Q1, target_Q) + F.mse_loss(
-            current_Q2, target_Q)
-
-        Q1_aug, Q2_aug = self.critic(obs_aug, action)
-
-        critic_loss += F.mse_loss(Q1_aug, target_Q) + F.mse_loss(
-            Q2_aug, target_Q)
-
-        logger.log('train_critic/loss', critic_loss, step)
+        with self.autocast():
+            # both augmented views go through the networks as a single batch
+            with torch.no_grad():
+                dist = self.actor(torch.cat([next_obs, next_obs_aug]))
+                next_action = dist.rsample()
+                log_prob = dist.log_prob(next_action).sum(-1, keepdim=True)
+                target_Q1, target_Q2 = self.critic_target(
+                    torch.cat([next_obs, next_obs_aug]), next_action)
+                target_V = torch.min(
+                    target_Q1, target_Q2) - self.alpha.detach() * log_prob
+                target_V, target_V_aug = target_V.chunk(2)
+                target_Q = reward + (not_done * self.discount * target_V)
+                target_Q_aug = reward + (not_done * self.discount *
+                                         target_V_aug)
+
+                target_Q = (target_Q + target_Q_aug) / 2
+
+            # get current Q estimates
+            current_Q1, current_Q2 = self.critic(torch.cat([obs, obs_aug]),
+                                                 action.repeat(2, 1))
+            target_Q = target_Q.repeat(2, 1)
+            # the sum of the per-view losses used by DrQ
+            critic_loss = 2 * (F.mse_loss(current_Q1, target_Q) +
+                               F.mse_loss(current_Q2, target_Q))
+
+            logger.log('train_critic/loss', critic_loss, step)
 
         # Optimize the critic
         self.critic_optimizer.zero_grad()
@@ -260,20 +265,23 @@ class DRQAgent(object):
         self.critic.log(logger, step)
 
     def update_actor_and_alpha(self, obs, logger, step):
-        # detach conv filters, so we don't update them with the actor loss
-        dist = self.actor(obs, detach_encoder=True)
-        action = dist.rsample()
-        log_prob = dist.log_prob(action).sum(-1, keepdim=True)
-        # detach conv filters, so we don't update them with the actor loss
-        actor_Q1, actor_Q2 = self.critic(obs, action, detach_encoder=True)
+        with self.autocast():
+            # detach conv filters, so we don't update them with the actor loss
+            dist = self.actor(obs, detach_encoder=True)
+            action = dist.rsample()
+            log_prob = dist.log_prob(action).sum(-1, keepdim=True)
+            # detach conv filters, so we don't update them with the actor loss
+            actor_Q1, actor_Q2 = self.critic(obs,
+                                             action,
+                                             detach_encoder=True)
 
-        actor_Q = torch.min(actor_Q1, actor_Q2)
+            actor_Q = torch.min(actor_Q1, actor_Q2)
 
-        actor_loss = (self.alpha.detach() * log_prob - actor_Q).mean()
+            actor_loss = (self.alpha.detach() * log_prob - actor_Q).mean()
 
-        logger.log('train_actor/loss', actor_loss, step)
-        logger.log('train_actor/target_entropy', self.target_entropy, step)
-        logger.log('train_actor/entropy', -log_prob.mean(), step)
+            logger.log('train_actor/loss', actor_loss, step)
+            logger.log('train_actor/target_entropy', self.target_entropy, step)
+            logger.log('train_actor/entropy', -log_prob.mean(), step)
 
         # optimize the actor
         self.actor_optimizer.zero_grad()
@@ -299,9 +307,13 @@ class DRQAgent(object):
         self.update_critic(obs, obs_aug, action, reward, next_obs,
                            next_obs_aug, not_done, logger, step)
 
-        if step % self.actor_update_frequency == 0:
+        # update frequencies count gradient steps, which need not advance
+        # in lockstep with environment steps
+        if self.num_updates % self.actor_update_frequency == 0:
             self.update_actor_and_alpha(obs, logger, step)
 
-        if step % self.critic_target_update_frequency == 0:
+        if self.num_updates % self.critic_target_update_frequency == 0:
             utils.soft_update_params(self.critic, self.critic_target,
                                      self.critic_tau)
+
+        self.num_updates += 1
@@ -1,7 +1,10 @@
 import csv
 import json
 import os
+import queue
 import shutil
+import threading
+import traceback
 from collections import defaultdict
 
 import numpy as np
@@ -39,6 +42,45 @@ class AverageMeter(object):
         return self._sum / max(1, self._count)
 
 
+class AsyncSummaryWriter(object):
+    """Forwards writes to a SummaryWriter from a background thread, so that
+    converting tensors and serializing summaries stays off the training loop."""
+    def __init__(self, log_dir):
+        self._sw = SummaryWriter(log_dir)
+        # bounded, so a slow writer applies backpressure instead of holding
+        # on to an ever growing number of tensors
+        self._queue = queue.Queue(maxsize=1000)
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def _worker(self):
+        while True:
+            fn, args, kwargs = self._queue.get()
+            try:
+                fn(*args, **kwargs)
+            except Exception:
+                print("logger.py warning: unable to write summary")
+                traceback.print_exc()
+            finally:
+                self._queue.task_done()
+
+    def add_scalar(self, *args, **kwargs):
+        self._queue.put((self._sw.add_scalar, args, kwargs))
+
+    def add_image(self, *args, **kwargs):
+        self._queue.put((self._sw.add_image, args, kwargs))
+
+    def add_video(self, *args, **kwargs):
+        self._queue.put((self._sw.add_video, args, kwargs))
+
+    def add_histogram(self, *args, **kwargs):
+        self._queue.put((self._sw.add_histogram, args, kwargs))
+
+    def close(self):
+        self._queue.join()
+        self._sw.close()
+
+
 class MetersGroup(object):
     def __init__(self, file_name, formating):
         self._csv_file_name = self._prepare_file(file_name, 'csv')
@@ -64,7 +106,8 @@ class MetersGroup(object):
             else:
                 key = key[len('eval') + 1:]
             key = key.replace('/', '_')
-            data[key] = meter.value()
+            # meters may accumulate device tensors, synchronize only here
+            data[key] = float(meter.value())
         return data
 
     def _dump_to_csv(self, data):
@@ -124,7 +167,7 @@ class Logger(object):
                 except:
                     print("logger.py warning: Unable to remove tb directory")
                     pass
-            self._sw = SummaryWriter(tb_dir)
+            self._sw = AsyncSummaryWriter(tb_dir)
         else:
             self._sw = None
         # each agent has specific output format for training
@@ -151,6 +194,8 @@ class Logger(object):
         step = self._update_step(step)
         if self._sw is not None:
             assert image.dim() == 3
+            # tensorboard cannot serialize reduced precision activations
+            image = image.float()
             grid = torchvision.utils.make_grid(image.unsqueeze(1))
             self._sw.add_image(key, grid, step)
 
@@ -164,6 +209,9 @@ class Logger(object):
     def _try_sw_log_histogram(self, key, histogram, step):
         step = self._update_step(step)
         if self._sw is not None:
+            if type(histogram) == torch.Tensor:
+                # copy, parameters are updated in place before the write
+                histogram = histogram.detach().to(torch.float32, copy=True)
             self._sw.add_histogram(key, histogram, step)
 
     def log(self, key, value, step, n=1, log_frequency=1):
@@ -171,7 +219,8 @@ class Logger(object):
             return
         assert key.startswith('train') or key.startswith('eval')
         if type(value) == torch.Tensor:
-            value = value.item()
+            # avoid a device sync per call, the value is read on dump
+            value = value.detach()
         self._try_sw_log(key, value / n, step)
         mg = self._train_mg if key.startswith('train') else self._eval_mg
         mg.log(key, value, n)
@@ -205,6 +254,10 @@ class Logger(object):
         assert key.startswith('train') or key.startswith('eval')
         self._try_sw_log_histogram(key, histogram, step)
 
+    def close(self):
+        if self._sw is not None:
+            self._sw.close()
+
     def dump(self, step, save=True, ty=None):
         step = self._update_step(step)
         if ty is None:
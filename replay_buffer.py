@@ -1,21 +1,29 @@
+import queue
+import threading
+
 import numpy as np
 
-import kornia
 import torch
-import torch.nn as nn
-import torch.nn.functional as F
 import utils
 
 
 class ReplayBuffer(object):
     """Buffer to store environment transitions."""
-    def __init__(self, obs_shape, action_shape, capacity, image_pad, device):
+    def __init__(self,
+                 obs_shape,
+                 action_shape,
+                 capacity,
+                 image_pad,
+                 device,
+                 channels_last=False):
         self.capacity = capacity
         self.device = device
+        if channels_last:
+            self.memory_format = torch.channels_last
+        else:
+            self.memory_format = torch.contiguous_format
 
-        self.aug_trans = nn.Sequential(
-            nn.ReplicationPad2d(image_pad),
-            kornia.augmentation.RandomCrop((obs_shape[-1], obs_shape[-1])))
+        self.image_pad = image_pad
 
         self.obses = np.empty((capacity, *obs_shape), dtype=np.uint8)
         self.next_obses = np.empty((capacity, *obs_shape), dtype=np.uint8)
@@ -26,45 +34,144 @@ class ReplayBuffer(object):
 
         self.idx = 0
         self.full = False
+        # guards the arrays against a concurrent PrefetchSampler thread,
+        # np.copyto and np.take release the GIL
+        self.lock = threading.Lock()
 
     def __len__(self):
         return self.capacity if self.full else self.idx
 
     def add(self, obs, action, reward, next_obs, done, done_no_max):
-        np.copyto(self.obses[self.idx], obs)
-        np.copyto(self.actions[self.idx], action)
-        np.copyto(self.rewards[self.idx], reward)
-        np.copyto(self.next_obses[self.idx], next_obs)
-        np.copyto(self.not_dones[self.idx], not done)
-        np.copyto(self.not_dones_no_max[self.idx], not done_no_max)
+        self.add_batch(np.expand_dims(obs, 0), np.expand_dims(action, 0),
+                       [reward], np.expand_dims(next_obs, 0), [done],
+                       [done_no_max])
 
-        self.idx = (self.idx + 1) % self.capacity
-        self.full = self.full or self.idx == 0
+    def add_batch(self, obses, actions, rewards, next_obses, dones,
+                  dones_no_max):
+        """Adds N transitions at once, with at most two slice copies per
+        field when the batch wraps around the end of the buffer."""
+        n = len(obses)
+        assert n <= self.capacity
+        rewards = np.reshape(rewards, (n, 1))
+        not_dones = np.logical_not(np.reshape(dones, (n, 1)))
+        not_dones_no_max = np.logical_not(np.reshape(dones_no_max, (n, 1)))
 
-    def sample(self, batch_size):
-        idxs = np.random.randint(0,
-                                 self.capacity if self.full else self.idx,
-                                 size=batch_size)
-
-        obses = self.obses[idxs]
-        next_obses = self.next_obses[idxs]
-        obses_aug = obses.copy()
-        next_obses_aug = next_obses.copy()
-
-        obses = torch.as_tensor(obses, device=self.device).float()
-        next_obses = torch.as_tensor(next_obses, device=self.device).float()
-        obses_aug = torch.as_tensor(obses_aug, device=self.device).float()
-        next_obses_aug = torch.as_tensor(next_obses_aug,
-                                         device=self.device).float()
-        actions = torch.as_tensor(self.actions[idxs], device=self.device)
-        rewards = torch.as_tensor(self.rewards[idxs], device=self.device)
-        not_dones_no_max = torch.as_tensor(self.not_dones_no_max[idxs],
-                                           device=self.device)
-
-        obses = self.aug_trans(obses)
-        next_obses = self.aug_trans(next_obses)
-
-        obses_aug = self.aug_trans(obses_aug)
-        next_obses_aug = self.aug_trans(next_obses_aug)
+        with self.lock:
+            first = min(n, self.capacity - self.idx)
+            for dst, src in [
+                (slice(self.idx, self.idx + first), slice(0, first)),
+                (slice(0, n - first), slice(first, n))
+            ]:
+                np.copyto(self.obses[dst], obses[src])
+                np.copyto(self.actions[dst], actions[src])
+                np.copyto(self.rewards[dst], rewards[src])
+                np.copyto(self.next_obses[dst], next_obses[src])
+                np.copyto(self.not_dones[dst], not_dones[src])
+                np.copyto(self.not_dones_no_max[dst], not_dones_no_max[src])
+
+            self.full = self.full or self.idx + n >= self.capacity
+            self.idx = (self.idx + n) % self.capacity
+
+    def _to_device(self, array, idxs):
+        """Gathers rows into pinned memory and copies them asynchronously."""
+        if self.device.type != 'cuda':
+            return torch.as_tensor(array[idxs], device=self.device)
+        staging = torch.empty((len(idxs), *array.shape[1:]),
+                              dtype=torch.as_tensor(array[:0]).dtype,
+                              pin_memory=True)
+        np.take(array, idxs, axis=0, out=staging.numpy())
+        return staging.to(self.device, non_blocking=True)
+
+    def sample(self, batch_size, rng=None, generator=None):
+        """Samples a batch, drawing indices from `rng` (a numpy Generator)
+        and crop offsets from `generator` (a torch Generator on the device)
+        instead of the global random state if given."""
+        with self.lock:
+            high = self.capacity if self.full else self.idx
+            if rng is None:
+                idxs = np.random.randint(0, high, size=batch_size)
+            else:
+                idxs = rng.integers(0, high, size=batch_size)
+
+            # frames are transferred as uint8 and only cast on the device
+            obses = self._to_device(self.obses, idxs)
+            next_obses = self._to_device(self.next_obses, idxs)
+            actions = self._to_device(self.actions, idxs)
+            rewards = self._to_device(self.rewards, idxs)
+            not_dones_no_max = self._to_device(self.not_dones_no_max, idxs)
+
+        # crop both augmented views of obs and next_obs in one pass on the
+        # uint8 frames, then cast once (float() keeps the memory format)
+        frames = torch.cat([obses, next_obses, obses, next_obses])
+        frames = utils.random_crop(frames, self.image_pad, generator)
+        frames = frames.contiguous(memory_format=self.memory_format).float()
+        obses, next_obses, obses_aug, next_obses_aug = frames.chunk(4)
 
         return obses, actions, rewards, next_obses, not_dones_no_max, obses_aug, next_obses_aug
+
+
+class PrefetchSampler(object):
+    """Samples replay buffer batches ahead of time in a background thread.
+
+    The next batches are gathered, copied to the device and augmented on a
+    separate CUDA stream while the current one is used for training. Exposes
+    the same sample() interface as ReplayBuffer so the agent is unaware of it.
+    """
+    def __init__(self,
+                 replay_buffer,
+                 batch_size,
+                 device,
+                 seed,
+                 num_prefetch=2):
+        self.replay_buffer = replay_buffer
+        self.batch_size = batch_size
+        # private random streams, the global ones are shared with the
+        # training thread and would interleave depending on scheduling
+        self.rng = np.random.default_rng(seed)
+        self.generator = torch.Generator(device=device)
+        self.generator.manual_seed(seed)
+        self.stream = torch.cuda.Stream(
+            device) if device.type == 'cuda' else None
+        self.queue = queue.Queue(maxsize=num_prefetch)
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+
+    def __len__(self):
+        return len(self.replay_buffer)
+
+    def _sample(self):
+        return self.replay_buffer.sample(self.batch_size,
+                                         rng=self.rng,
+                                         generator=self.generator)
+
+    def _worker(self):
+        try:
+            while True:
+                if self.stream is None:
+                    self.queue.put((self._sample(), None))
+                    continue
+                with torch.cuda.stream(self.stream):
+                    batch = self._sample()
+                    event = torch.cuda.Event()
+                    event.record(self.stream)
+                self.queue.put((batch, event))
+        except Exception as e:
+            # hand the error to the training thread instead of dying silently
+            self.queue.put((e, None))
+
+    def sample(self, batch_size):
+        assert batch_size == self.batch_size
+        # start lazily, the buffer has to contain data before sampling
+        if self.thread.ident is None:
+            self.thread.start()
+        batch, event = self.queue.get()
+        if isinstance(batch, Exception):
+            # the worker is gone, keep raising on later calls too
+            self.queue.put((batch, None))
+            raise batch
+        if event is not None:
+            current_stream = torch.cuda.current_stream()
+            current_stream.wait_event(event)
+            # the tensors were allocated on the prefetch stream
+            for tensor in batch:
+                tensor.record_stream(current_stream)
+        return batch
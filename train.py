@@ -1,5 +1,6 @@
-import copy
+import functools
 import math
+import multiprocessing as mp
 import os
 import pickle as pkl
 import sys
@@ -7,6 +8,14 @@ import time
 
 import numpy as np
 
+# render dm_control frames on the GPU through EGL instead of falling back to
+# the software OSMesa rasterizer, must be set before dm_control is imported
+os.environ.setdefault('MUJOCO_GL', 'egl')
+# keep torch.compile artifacts across runs, read when torch is imported
+os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR',
+                      os.path.expanduser('~/.cache/drq/inductor'))
+os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+
 import dmc2gym
 import hydra
 import torch
@@ -14,13 +23,16 @@ import torch.nn as nn
 import torch.nn.functional as F
 import utils
 from logger import Logger
-from replay_buffer import ReplayBuffer
+from replay_buffer import PrefetchSampler, ReplayBuffer
+from vec_env import SubprocVecEnv
 from video import VideoRecorder
 
 torch.backends.cudnn.benchmark = True
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
 
 
-def make_env(cfg):
+def make_env(cfg, rank=0):
     """Helper function to create dm_control environment"""
     if cfg.env == 'ball_in_cup_catch':
         domain_name = 'ball_in_cup'
@@ -37,7 +49,7 @@ def make_env(cfg):
 
     env = dmc2gym.make(domain_name=domain_name,
                        task_name=task_name,
-                       seed=cfg.seed,
+                       seed=cfg.seed + rank,
                        visualize_reward=False,
                        from_pixels=True,
                        height=cfg.image_size,
@@ -47,7 +59,7 @@ def make_env(cfg):
 
     env = utils.FrameStack(env, k=cfg.frame_stack)
 
-    env.seed(cfg.seed)
+    env.seed(cfg.seed + rank)
     assert env.action_space.low.min() >= -1
     assert env.action_space.high.max() <= 1
 
@@ -61,37 +73,123 @@ class Workspace(object):
 
         self.cfg = cfg
 
+        utils.set_seed_everywhere(cfg.seed)
+        self.device = torch.device(cfg.device)
+        # dmc2gym renders channels-first RGB frames, stacked by FrameStack
+        obs_shape = (3 * cfg.frame_stack, cfg.image_size, cfg.image_size)
+        env_fns = [
+            functools.partial(make_env, cfg, rank)
+            for rank in range(cfg.num_envs)
+        ]
+        self.env = SubprocVecEnv(env_fns, obs_shape=obs_shape)
+        assert self.env.observation_space.shape == obs_shape
+
+        self.video_recorder = VideoRecorder(
+            self.work_dir if cfg.save_video else None)
+
+        # evaluation runs in the main process so videos can be rendered, it
+        # loads dm_control and EGL here, so only after all forks are done
+        self.eval_env = make_env(cfg)
+
+        # created after all subprocesses are forked, it starts a writer thread
         self.logger = Logger(self.work_dir,
                              save_tb=cfg.log_save_tb,
                              log_frequency=cfg.log_frequency_step,
                              agent=cfg.agent.name,
                              action_repeat=cfg.action_repeat)
 
-        utils.set_seed_everywhere(cfg.seed)
-        self.device = torch.device(cfg.device)
-        self.env = make_env(cfg)
-
         cfg.agent.params.obs_shape = self.env.observation_space.shape
         cfg.agent.params.action_shape = self.env.action_space.shape
         cfg.agent.params.action_range = [
             float(self.env.action_space.low.min()),
             float(self.env.action_space.high.max())
         ]
+        self.action_low = torch.as_tensor(self.env.action_space.low)
+        self.action_high = torch.as_tensor(self.env.action_space.high)
         self.agent = hydra.utils.instantiate(cfg.agent)
+        if cfg.channels_last:
+            # converts the conv weights in place, so tied weights stay tied
+            self.agent.actor.to(memory_format=torch.channels_last)
+            self.agent.critic.to(memory_format=torch.channels_last)
+            self.agent.critic_target.to(memory_format=torch.channels_last)
+        if cfg.compile_agent:
+            self.agent.actor = torch.compile(self.agent.actor,
+                                             mode='reduce-overhead',
+                                             dynamic=False)
+            self.agent.critic = torch.compile(self.agent.critic,
+                                              mode='reduce-overhead',
+                                              dynamic=False)
+            self.agent.critic_target = torch.compile(self.agent.critic_target,
+                                                     mode='reduce-overhead',
+                                                     dynamic=False)
+        # pick the cudnn algorithms (and compile) before training starts
+        self.warmup_agent()
 
         self.replay_buffer = ReplayBuffer(self.env.observation_space.shape,
                                           self.env.action_space.shape,
                                           cfg.replay_buffer_capacity,
-                                          self.cfg.image_pad, self.device)
-
-        self.video_recorder = VideoRecorder(
-            self.work_dir if cfg.save_video else None)
+                                          self.cfg.image_pad, self.device,
+                                          cfg.channels_last)
+        self.sampler = PrefetchSampler(self.replay_buffer, cfg.batch_size,
+                                       self.device, cfg.seed)
         self.step = 0
 
+    def warmup_agent(self):
+        """Runs the networks once on every input shape, memory format and
+        precision used in acting and training. Each call repeats the grad
+        mode, training flag and autocast state of the matching call in
+        DRQAgent.act or DRQAgent.update."""
+        obs_shape = self.env.observation_space.shape
+        action_shape = self.env.action_space.shape
+        # batched acting during collection and single obs during evaluation,
+        # act() runs in eval mode under no_grad, on fresh NCHW tensors and
+        # outside of autocast
+        for batch_size in {self.cfg.num_envs, 1}:
+            obs = torch.zeros((batch_size, *obs_shape), device=self.device)
+            with torch.no_grad(), utils.eval_mode(self.agent):
+                self.agent.actor(obs)
+
+        # sampled batches come in the replay buffer's memory format
+        if self.cfg.channels_last:
+            memory_format = torch.channels_last
+        else:
+            memory_format = torch.contiguous_format
+
+        def zeros(batch_size, shape):
+            return torch.zeros((batch_size, *shape), device=self.device)
+
+        # updates run in training mode, the agent's default outside of act()
+        batch_size = self.cfg.batch_size
+        with self.agent.autocast():
+            # update_critic runs both augmented views as one batch
+            obs = zeros(2 * batch_size,
+                        obs_shape).contiguous(memory_format=memory_format)
+            action = zeros(2 * batch_size, action_shape)
+            with torch.no_grad():
+                self.agent.actor(obs)
+                self.agent.critic_target(obs, action)
+            current_Q1, current_Q2 = self.agent.critic(obs, action)
+            critic_loss = current_Q1.sum() + current_Q2.sum()
+
+            # update_actor_and_alpha
+            obs = zeros(batch_size,
+                        obs_shape).contiguous(memory_format=memory_format)
+            action = zeros(batch_size, action_shape)
+            dist = self.agent.actor(obs, detach_encoder=True)
+            actor_Q1, actor_Q2 = self.agent.critic(obs,
+                                                   action,
+                                                   detach_encoder=True)
+            actor_loss = dist.mean.sum() + actor_Q1.sum() + actor_Q2.sum()
+        # the backward passes are tuned (and compiled) on first use as well
+        critic_loss.backward()
+        actor_loss.backward()
+        self.agent.critic_optimizer.zero_grad()
+        self.agent.actor_optimizer.zero_grad()
+
     def evaluate(self):
         average_episode_reward = 0
         for episode in range(self.cfg.num_eval_episodes):
-            obs = self.env.reset()
+            obs = self.eval_env.reset()
             self.video_recorder.init(enabled=(episode == 0))
             done = False
             episode_reward = 0
@@ -99,8 +197,8 @@ class Workspace(object):
             while not done:
                 with utils.eval_mode(self.agent):
                     action = self.agent.act(obs, sample=False)
-                obs, reward, done, info = self.env.step(action)
-                self.video_recorder.record(self.env)
+                obs, reward, done, info = self.eval_env.step(action)
+                self.video_recorder.record(self.eval_env)
                 episode_reward += reward
                 episode_step += 1
 
@@ -112,7 +210,12 @@ class Workspace(object):
         self.logger.dump(self.step)
 
     def run(self):
-        episode, episode_reward, episode_step, done = 0, 0, 1, True
+        num_envs = self.cfg.num_envs
+        episode, episode_step, done = 0, 1, True
+        episode_reward = np.zeros(num_envs, dtype=np.float32)
+        eval_step = 0
+        pending_updates = 0.
+        last_update_step = self.cfg.num_seed_steps - 1
         start_time = time.time()
         while self.step < self.cfg.num_train_steps:
             if done:
@@ -124,55 +227,83 @@ class Workspace(object):
                         self.step, save=(self.step > self.cfg.num_seed_steps))
 
                 # evaluate agent periodically
-                if self.step % self.cfg.eval_frequency == 0:
+                if self.step >= eval_step:
                     self.logger.log('eval/episode', episode, self.step)
                     self.evaluate()
+                    eval_step += self.cfg.eval_frequency
 
-                self.logger.log('train/episode_reward', episode_reward,
+                self.logger.log('train/episode_reward', episode_reward.mean(),
                                 self.step)
 
+                # all envs share the same time limit and are reset together
                 obs = self.env.reset()
                 done = False
-                episode_reward = 0
+                episode_reward[:] = 0
                 episode_step = 0
-                episode += 1
+                episode += num_envs
 
                 self.logger.log('train/episode', episode, self.step)
 
             # sample action for data collection
             if self.step < self.cfg.num_seed_steps:
-                action = self.env.action_space.sample()
+                action = torch.rand((num_envs, *self.action_low.shape))
+                action = (action * (self.action_high - self.action_low) +
+                          self.action_low).numpy()
             else:
                 with utils.eval_mode(self.agent):
                     action = self.agent.act(obs, sample=True)
 
-            # run training update
-            if self.step >= self.cfg.num_seed_steps:
-                for _ in range(self.cfg.num_train_iters):
-                    self.agent.update(self.replay_buffer, self.logger,
-                                      self.step)
+            # the env workers render the next frames while the agent trains
+            self.env.step_async(action)
 
-            next_obs, reward, done, info = self.env.step(action)
+            # run training updates in proportion to the collected transitions
+            if self.step >= self.cfg.num_seed_steps:
+                pending_updates += self.cfg.replay_ratio * num_envs
+                num_updates = int(pending_updates)
+                pending_updates -= num_updates
+                for i in range(num_updates):
+                    update_step = self.step + i * num_envs // num_updates
+                    # with a fractional ratio or several envs the update steps
+                    # can skip the multiples of log_frequency_step that
+                    # trigger network logging, snap to a skipped multiple
+                    log_step = update_step - (update_step %
+                                              self.cfg.log_frequency_step)
+                    if log_step > last_update_step:
+                        update_step = log_step
+                    self.agent.update(self.sampler, self.logger, update_step)
+                    last_update_step = update_step
+
+            next_obs, reward, dones, info = self.env.step_wait()
 
             # allow infinite bootstrap
-            done = float(done)
-            done_no_max = 0 if episode_step + 1 == self.env._max_episode_steps else done
+            dones = dones.astype(np.float32)
+            dones_no_max = np.where(
+                episode_step + 1 == self.env._max_episode_steps, 0., dones)
+            self.replay_buffer.add_batch(obs, action, reward, next_obs, dones,
+                                         dones_no_max)
             episode_reward += reward
 
-            self.replay_buffer.add(obs, action, reward, next_obs, done,
-                                   done_no_max)
-
+            done = dones.any()
             obs = next_obs
             episode_step += 1
-            self.step += 1
+            self.step += num_envs
 
 
 @hydra.main(config_path='config.yaml', strict=True)
 def main(cfg):
     from train import Workspace as W
     workspace = W(cfg)
-    workspace.run()
+    try:
+        workspace.run()
+    finally:
+        workspace.env.close()
+        workspace.video_recorder.close()
+        workspace.logger.close()
 
 
 if __name__ == '__main__':
+    # env workers are forked to start from the parent's imported modules.
+    # dm_control is deliberately not among them: with MUJOCO_GL=egl importing
+    # it initializes an EGL display, which must not be inherited across fork
+    mp.set_start_method('fork')
     main()
@@ -1,7 +1,6 @@
 import math
 import os
 import random
-from collections import deque
 
 import numpy as np
 import scipy.linalg as sp_la
@@ -95,12 +94,49 @@ def to_np(t):
         return t.cpu().detach().numpy()
 
 
+def random_crop(imgs, pad, generator=None):
+    """Takes a random crop of the original size from each image as if it had
+    been replicate-padded by `pad`, in a single gather over the whole batch.
+
+    Clamping the indices to the image border reproduces replicate padding
+    without materializing the padded batch, so this also works on uint8.
+    """
+    n, c, h, w = imgs.shape
+    h_offsets = torch.randint(0,
+                              2 * pad + 1, (n, 1, 1),
+                              generator=generator,
+                              device=imgs.device)
+    w_offsets = torch.randint(0,
+                              2 * pad + 1, (n, 1, 1),
+                              generator=generator,
+                              device=imgs.device)
+    rows = h_offsets - pad + torch.arange(h, device=imgs.device).view(1, h, 1)
+    cols = w_offsets - pad + torch.arange(w, device=imgs.device).view(1, 1, w)
+    rows = rows.clamp(0, h - 1)
+    cols = cols.clamp(0, w - 1)
+    batch = torch.arange(n, device=imgs.device).view(n, 1, 1)
+    # advanced indices around a slice put the channel dim last: (n, h, w, c),
+    # so the permuted result is laid out in channels_last memory format
+    crops = imgs[batch, :, rows, cols]
+    return crops.permute(0, 3, 1, 2)
+
+
 class FrameStack(gym.Wrapper):
+    """Stacks the last k frames along the channel dimension.
+
+    Frames live in a ring buffer that stores every slot twice, so the stacked
+    observation is always a contiguous view and no copy is made per step. The
+    returned observation is only valid until the next call to step or reset.
+    """
     def __init__(self, env, k):
         gym.Wrapper.__init__(self, env)
         self._k = k
-        self._frames = deque([], maxlen=k)
         shp = env.observation_space.shape
+        self._channels = shp[0]
+        self._frames = np.empty((2 * k * shp[0],) + shp[1:],
+                                dtype=env.observation_space.dtype)
+        # slot holding the oldest frame, overwritten by the next one
+        self._head = 0
         self.observation_space = gym.spaces.Box(
             low=0,
             high=1,
@@ -111,17 +147,23 @@ class FrameStack(gym.Wrapper):
     def reset(self):
         obs = self.env.reset()
         for _ in range(self._k):
-            self._frames.append(obs)
+            self._append(obs)
         return self._get_obs()
 
     def step(self, action):
         obs, reward, done, info = self.env.step(action)
-        self._frames.append(obs)
+        self._append(obs)
         return self._get_obs(), reward, done, info
 
+    def _append(self, obs):
+        c = self._channels
+        for slot in [self._head, self._head + self._k]:
+            np.copyto(self._frames[slot * c:(slot + 1) * c], obs)
+        self._head = (self._head + 1) % self._k
+
     def _get_obs(self):
-        assert len(self._frames) == self._k
-        return np.concatenate(list(self._frames), axis=0)
+        start = self._head * self._channels
+        return self._frames[start:start + self._k * self._channels]
 
 
 class TanhTransform(pyd.transforms.Transform):
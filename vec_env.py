@@ -0,0 +1,141 @@
+import multiprocessing as mp
+
+import numpy as np
+
+import cloudpickle
+
+
+class CloudpickleWrapper(object):
+    """Uses cloudpickle to serialize env constructors (closures, lambdas)."""
+    def __init__(self, fn):
+        self.fn = fn
+
+    def __getstate__(self):
+        return cloudpickle.dumps(self.fn)
+
+    def __setstate__(self, fn):
+        self.fn = cloudpickle.loads(fn)
+
+
+def _worker(remote, parent_remote, env_fn_wrapper, shared_obs, rank):
+    parent_remote.close()
+    env = env_fn_wrapper.fn()
+    if shared_obs is not None:
+        # rebuild the view here, a numpy array would be copied under spawn
+        raw, shape, dtype = shared_obs
+        shared_obs = np.frombuffer(raw, dtype=dtype).reshape(shape)[rank]
+
+    def send_obs(obs):
+        # each worker writes into its own slot of the shared block
+        if shared_obs is None:
+            return obs
+        np.copyto(shared_obs, obs)
+        return None
+
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == 'step':
+                obs, reward, done, info = env.step(data)
+                remote.send((send_obs(obs), reward, done, info))
+            elif cmd == 'reset':
+                remote.send(send_obs(env.reset()))
+            elif cmd == 'get_spaces':
+                remote.send((env.observation_space, env.action_space,
+                             env._max_episode_steps))
+            elif cmd == 'close':
+                remote.close()
+                break
+            else:
+                raise NotImplementedError(f'invalid command: {cmd}')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        env.close()
+
+
+class SubprocVecEnv(object):
+    """Steps several environments in parallel, one per subprocess.
+
+    Pixel rendering dominates the cost of a dm_control step, running each
+    environment in its own process lets the frames be rendered concurrently.
+    Unlike the baselines version, environments are not reset automatically
+    when an episode ends, so the true terminal observation is returned and
+    can be stored in the replay buffer.
+
+    If `obs_shape` is given, workers write their observations into a shared
+    memory block instead of pickling them through the pipe.
+    """
+    def __init__(self, env_fns, obs_shape=None, obs_dtype=np.uint8):
+        self.num_envs = len(env_fns)
+        self.waiting = False
+        self.closed = False
+
+        ctx = mp.get_context()
+        if obs_shape is not None:
+            obs_shape = (self.num_envs, *obs_shape)
+            nbytes = int(np.prod(obs_shape)) * np.dtype(obs_dtype).itemsize
+            raw = ctx.RawArray('B', nbytes)
+            shared_obs = (raw, obs_shape, obs_dtype)
+            self._obs = np.frombuffer(raw, dtype=obs_dtype).reshape(obs_shape)
+        else:
+            shared_obs = None
+            self._obs = None
+
+        self.remotes, self.work_remotes = zip(
+            *[ctx.Pipe() for _ in range(self.num_envs)])
+        self.processes = []
+        for rank, (work_remote, remote, env_fn) in enumerate(
+                zip(self.work_remotes, self.remotes, env_fns)):
+            args = (work_remote, remote, CloudpickleWrapper(env_fn),
+                    shared_obs, rank)
+            process = ctx.Process(target=_worker, args=args, daemon=True)
+            process.start()
+            self.processes.append(process)
+            work_remote.close()
+
+        self.remotes[0].send(('get_spaces', None))
+        spaces = self.remotes[0].recv()
+        self.observation_space, self.action_space = spaces[:2]
+        self._max_episode_steps = spaces[2]
+
+    def _stack_obs(self, obs):
+        if self._obs is None:
+            return np.stack(obs)
+        # copy, the workers overwrite the shared block on the next step
+        return self._obs.copy()
+
+    def reset(self):
+        for remote in self.remotes:
+            remote.send(('reset', None))
+        return self._stack_obs([remote.recv() for remote in self.remotes])
+
+    def step_async(self, actions):
+        assert len(actions) == self.num_envs
+        for remote, action in zip(self.remotes, actions):
+            remote.send(('step', action))
+        self.waiting = True
+
+    def step_wait(self):
+        results = [remote.recv() for remote in self.remotes]
+        self.waiting = False
+        obs, rewards, dones, infos = zip(*results)
+        rewards = np.array(rewards, dtype=np.float32)
+        dones = np.array(dones, dtype=np.bool_)
+        return self._stack_obs(obs), rewards, dones, infos
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def close(self):
+        if self.closed:
+            return
+        if self.waiting:
+            for remote in self.remotes:
+                remote.recv()
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for process in self.processes:
+            process.join()
+        self.closed = True
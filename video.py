@@ -1,5 +1,8 @@
+import multiprocessing as mp
 import os
+import queue
 import sys
+import traceback
 
 import imageio
 import numpy as np
@@ -7,26 +10,71 @@ import numpy as np
 import utils
 
 
+def _writer(frames_queue, fps):
+    frames = []
+    while True:
+        cmd, data = frames_queue.get()
+        if cmd == 'frame':
+            frames.append(data)
+        elif cmd == 'save':
+            # report and keep consuming, a dead writer would block the trainer
+            try:
+                imageio.mimsave(data, frames, fps=fps)
+            except Exception:
+                print(f'video.py warning: unable to save {data}',
+                      file=sys.stderr)
+                traceback.print_exc()
+        elif cmd == 'reset':
+            frames = []
+        elif cmd == 'close':
+            break
+
+
 class VideoRecorder(object):
+    """Renders evaluation frames and encodes them in a separate process, so
+    saving a video does not block training."""
     def __init__(self, root_dir, height=256, width=256, fps=10):
         self.save_dir = utils.make_dir(root_dir, 'video') if root_dir else None
         self.height = height
         self.width = width
         self.fps = fps
-        self.frames = []
+        self.enabled = False
+        if self.save_dir is not None:
+            self.queue = mp.Queue(maxsize=256)
+            self.process = mp.Process(target=_writer,
+                                      args=(self.queue, fps),
+                                      daemon=True)
+            self.process.start()
+
+    def _put(self, item):
+        while True:
+            if not self.process.is_alive():
+                raise RuntimeError('video writer process died')
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
 
     def init(self, enabled=True):
-        self.frames = []
         self.enabled = self.save_dir is not None and enabled
+        if self.enabled:
+            self._put(('reset', None))
 
     def record(self, env):
         if self.enabled:
             frame = env.render(mode='rgb_array',
                                height=self.height,
                                width=self.width)
-            self.frames.append(frame)
+            self._put(('frame', frame))
 
     def save(self, file_name):
         if self.enabled:
             path = os.path.join(self.save_dir, file_name)
-            imageio.mimsave(path, self.frames, fps=self.fps)
+            self._put(('save', path))
+
+    def close(self):
+        """Waits for the pending videos to be written."""
+        if self.save_dir is not None and self.process.is_alive():
+            self._put(('close', None))
+            self.process.join()